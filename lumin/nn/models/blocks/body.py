@@ -1,8 +1,11 @@
-from typing import Optional, Callable, Any, List, Dict
+from typing import Optional, Callable, Any, List, Dict, Tuple
 import numpy as np
 from functools import partial
+import copy
+from distutils.version import LooseVersion
 
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 from torch import Tensor
 
@@ -13,6 +16,50 @@ from .abs_block import AbsBlock
 __all__ = ['IdentBody', 'FullyConnected', 'MultiBlock']
 
 
+def _get_bn_affine(bn:nn.BatchNorm1d) -> Tuple[Tensor,Tensor]:
+    r'''
+    Compute the scale and shift which are equivalent to applying the batchnorm in evaluation mode
+    '''
+
+    scale = torch.rsqrt(bn.running_var+bn.eps)
+    if bn.weight is not None: scale = scale*bn.weight
+    shift = -bn.running_mean*scale
+    if bn.bias is not None: shift = shift+bn.bias
+    return scale, shift
+
+
+def _fold_bn_into_prev(lin:nn.Linear, bn:nn.BatchNorm1d) -> None:
+    r'''
+    Fold batchnorm into the linear layer whose output it normalises: W' = s*W, b' = s*b+t
+    '''
+
+    scale, shift = _get_bn_affine(bn)
+    dtype = torch.promote_types(lin.weight.dtype, scale.dtype)  # Batchnorm may be kept at higher precision than linear, e.g. after to_inference_dtype
+    with torch.no_grad():
+        lin.bias.copy_((lin.bias.to(dtype)*scale)+shift)
+        lin.weight.copy_(lin.weight.to(dtype)*scale[:,None])
+
+
+def _fold_bn_into_next(bn:nn.BatchNorm1d, lin:nn.Linear) -> None:
+    r'''
+    Fold batchnorm into the linear layer to which its output is passed: W' = W*s, b' = b+W.t
+    '''
+
+    scale, shift = _get_bn_affine(bn)
+    dtype = torch.promote_types(lin.weight.dtype, scale.dtype)
+    with torch.no_grad():
+        lin.bias.copy_(lin.bias.to(dtype)+(lin.weight.to(dtype)@shift))
+        lin.weight.copy_(lin.weight.to(dtype)*scale[None,:])
+
+
+def _has_state(m:nn.Module) -> bool:
+    r'''
+    Check whether module has its own parameters or buffers
+    '''
+
+    return any(True for _ in m.parameters(recurse=False)) or any(True for _ in m.buffers(recurse=False))
+
+
 class AbsBody(AbsBlock):
     def __init__(self, n_in:int, feat_map:Dict[str,List[int]],
                  lookup_init:Callable[[str,Optional[int],Optional[int]],Callable[[Tensor],None]]=lookup_normal_init,
@@ -32,6 +79,37 @@ class IdentBody(AbsBody):
     def get_out_size(self) -> int: return self.n_in
 
 
+def _remap_res_state_dict(state_dict:Dict[str,Tensor], prefix:str, *args, body_prefix:str='') -> None:
+    r'''
+    Map parameters of a residual :class:`~lumin.nn.models.blocks.body.FullyConnected` saved prior to the use of residual stages onto the stages, in place.
+    Only keys in the old layout are remapped, i.e. `res_bns.*`, and `layers.N.*` for N > 0 which are not already under `body` or `bn`.
+    Can be registered as a load-state-dict pre-hook, in which case `body_prefix` is the location of the block within the module.
+    '''
+
+    prefix += body_prefix
+    for k in [k for k in state_dict if k.startswith(prefix)]:
+        name = k[len(prefix):].split('.')
+        if   name[0] == 'res_bns':                                                                         name = ['layers', str(int(name[1])+1), 'bn']+name[2:]
+        elif name[0] == 'layers' and len(name) > 2 and int(name[1]) > 0 and name[2] not in ['body', 'bn']: name = name[:2]+['body']+name[2:]
+        else:                                                                                              continue
+        state_dict[prefix+'.'.join(name)] = state_dict.pop(k)
+
+
+class _ResStage(nn.Module):
+    r'''
+    Residual stage of :class:`~lumin.nn.models.blocks.body.FullyConnected`: the layers, the skip connection, and the renormalisation after the addition are
+    kept in a single module, so that when scripted the addition and the elementwise tail of the batchnorm can be fused.
+    '''
+
+    def __init__(self, body:nn.Sequential, bn:nn.Module):
+        super().__init__()
+        self.body,self.bn = body,bn
+
+    def __getitem__(self, key:int) -> nn.Module: return self.body[key]
+
+    def forward(self, x:Tensor) -> Tensor: return self.bn(self.body(x)+x)
+
+
 class FullyConnected(AbsBody):
     r'''
     Fully connected set of hidden layers. Designed to be passed as a 'body' to :class:`~lumin.nn.models.model_builder.ModelBuilder`.
@@ -76,24 +154,26 @@ class FullyConnected(AbsBody):
         ...                       lookup_init=lookup_uniform_init)
     '''
 
+    __constants__ = ['res', 'dense', 'depth']  # Allows TorchScript to only compile the relevant branch of forward
+    inference_dtype:Optional[torch.dtype]
+
     def __init__(self, n_in:int, feat_map:Dict[str,List[int]], depth:int, width:int, do:float=0, bn:bool=False, act:str='relu', res:bool=False,
                  dense:bool=False, growth_rate:int=0, lookup_init:Callable[[str,Optional[int],Optional[int]],Callable[[Tensor],None]]=lookup_normal_init,
                  lookup_act:Callable[[str],Any]=lookup_act, freeze:bool=False, bn_class:Callable[[int],nn.Module]=nn.BatchNorm1d):
         super().__init__(n_in=n_in, feat_map=feat_map, lookup_init=lookup_init, lookup_act=lookup_act, freeze=freeze, bn_class=bn_class)
         self.depth,self.width,self.do,self.bn,self.act,self.res,self.dense,self.growth_rate = depth,width,do,bn,act,res,dense,growth_rate
+        self.inference_dtype = None
 
         if self.res:
             self.depth = 1+int(np.floor(self.depth/2))  # One upscale layer + each subsequent block will contain 2 layers
-            self.res_bns = nn.ModuleList([self.bn_class(self.width) for d in range(self.depth-1)])
-            self.layers = nn.ModuleList([self._get_layer(idx=d, fan_in=self.width, fan_out=self.width)
+            self.layers = nn.ModuleList([_ResStage(self._get_layer(idx=d, fan_in=self.width, fan_out=self.width), self.bn_class(self.width))
                                          if d > 0 else self._get_layer(idx=d, fan_in=self.n_in, fan_out=self.width)
                                          for d in range(self.depth)])
         elif self.dense:
-            self.layers = []
-            for d in range(self.depth):
-                self.layers.append(self._get_layer(idx=d, fan_in=self.n_in if d == 0 else self.n_in+np.sum([l[0].out_features for l in self.layers]),
-                                   fan_out=max(1,self.width+int(self.width*d*self.growth_rate))))
-            self.layers = nn.ModuleList(self.layers)
+            self._fan_outs = [max(1,self.width+int(self.width*d*self.growth_rate)) for d in range(self.depth)]
+            self._fan_ins = [self.n_in]
+            for w in self._fan_outs[:-1]: self._fan_ins.append(self._fan_ins[-1]+w)  # Each layer receives all previous outputs
+            self.layers = nn.ModuleList([self._get_layer(idx=d, fan_in=self._fan_ins[d], fan_out=self._fan_outs[d]) for d in range(self.depth)])
         else:
             self.layers = nn.Sequential(*[self._get_layer(idx=d, fan_in=self.width+int(self.width*(d-1)*self.growth_rate),
                                                           fan_out=self.width+int(self.width*d*self.growth_rate))
@@ -121,19 +201,120 @@ class FullyConnected(AbsBody):
         return nn.Sequential(*layers)
     
     def forward(self, x:Tensor) -> Tensor:
+        dtype = self.inference_dtype
+        if dtype is None: return self._forward(x)
+        return self._forward(x.to(dtype)).to(x.dtype)
+
+    def _forward(self, x:Tensor) -> Tensor:
         if self.dense:
-            for l in self.layers[:-1]: x = torch.cat((l(x), x), -1)
-            x = self.layers[-1](x)
+            if torch.is_grad_enabled():
+                for i, l in enumerate(self.layers):
+                    if i < self.depth-1: x = torch.cat((l(x), x), -1)
+                    else:                x = l(x)
+            else:  # Write layer outputs into a single buffer, right to left, rather than copying all previous outputs every layer. Not differentiable.
+                buf = x.new_empty(x.shape[0], self._fan_ins[-1])  # Not cached between calls: keeps forward stateless & thread-safe, and valid in inference_mode
+                off = buf.shape[1]-x.shape[1]
+                buf[:,off:] = x
+                for i, l in enumerate(self.layers):
+                    if i < self.depth-1:
+                        buf[:,off-self._fan_outs[i]:off] = l(buf[:,off:])
+                        off -= self._fan_outs[i]
+                    else:
+                        x = l(buf)
         elif self.res:
-            for i, l in enumerate(self.layers):
-                if i > 0:
-                    x = l(x)+x
-                    x = self.res_bns[i-1](x)  # Renormalise after addition
-                else:
-                    x = l(x)
+            for l in self.layers: x = l(x)  # Skip connections and renormalisations are applied within each _ResStage
         else:
             x = self.layers(x)
         return x
+
+    def fuse_for_inference(self) -> None:
+        r'''
+        Sets the block to evaluation mode and folds batchnorm layers into neighbouring linear layers wherever the combination is equivalent to a single linear
+        layer, i.e. when the batchnorm directly follows a linear layer, or when its output is only passed (via dropout) to the next linear layer.
+        Batchnorms after residual additions cannot be folded, since their outputs also feed the skip connections.
+        Only `nn.BatchNorm1d` layers with running statistics are folded. Folded batchnorms, and dropout layers (which are identities during inference), are
+        then removed from the layers, so that only the linear layers, activations, and any remaining batchnorms are called.
+        Afterwards the block should only be used for inference.
+        '''
+
+        self.eval()
+        pending = None  # Batchnorm whose output only feeds the next linear layer
+        for layer in self.layers:
+            if isinstance(layer, _ResStage): layer = layer.body
+            if self.res or self.dense: pending = None  # Outputs of each layer are reused by later layers
+            for i, m in enumerate(layer):
+                if isinstance(m, nn.Linear):
+                    if pending is not None:
+                        _fold_bn_into_next(pending[1], m)
+                        pending[0][pending[2]] = nn.Identity()
+                        pending = None
+                elif type(m) is nn.BatchNorm1d and m.track_running_stats:
+                    if i > 0 and isinstance(layer[i-1], nn.Linear):
+                        _fold_bn_into_prev(layer[i-1], m)
+                        layer[i] = nn.Identity()
+                    else:
+                        pending = (layer, m, i)
+                elif not isinstance(m, (nn.Dropout, nn.AlphaDropout, nn.Identity)):  # Non-linear operation between batchnorm and next linear layer
+                    pending = None
+        for i, layer in enumerate(self.layers):
+            if isinstance(layer, _ResStage): layer.body = nn.Sequential(*[m for m in layer.body if not isinstance(m, (nn.Dropout, nn.AlphaDropout, nn.Identity))])
+            else: self.layers[i] = nn.Sequential(*[m for m in layer if not isinstance(m, (nn.Dropout, nn.AlphaDropout, nn.Identity))])
+
+    def _load_from_state_dict(self, state_dict:Dict[str,Tensor], prefix:str, local_metadata:Dict[str,Any], strict:bool, missing_keys:List[str],
+                              unexpected_keys:List[str], error_msgs:List[str]) -> None:
+        if self.res: _remap_res_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def quantize_dynamic(self, fuse:bool=True) -> nn.Module:
+        r'''
+        Create a copy of the block in which the weights of the linear layers are quantised to 8-bit integers and activations are quantised dynamically,
+        for faster inference on CPU. Quantisation may reduce the performance of the model, which should be checked on validation data.
+
+        Arguments:
+            fuse: if true, will first call :meth:`~lumin.nn.models.blocks.body.FullyConnected.fuse_for_inference` on the copy, so that batchnorms are folded into
+                the linear layers prior to quantisation
+
+        Returns:
+            Quantised copy of the block, for inference only
+        '''
+
+        block = copy.deepcopy(self)
+        if fuse: block.fuse_for_inference()
+        else:    block.eval()
+        return torch.quantization.quantize_dynamic(block, {nn.Linear}, dtype=torch.qint8)
+
+    def to_inference_dtype(self, dtype:torch.dtype=torch.bfloat16) -> None:
+        r'''
+        Sets the block to evaluation mode and casts its parameters to a lower-precision floating-point type, halving the memory traffic of inference.
+        Batchnorm layers are kept in float32. Inputs are cast to the new type on entry and outputs are cast back to the type of the input, so the block can be
+        used with surrounding modules which remain in float32. Afterwards the block should only be used for inference.
+        Can be called either before or after :meth:`~lumin.nn.models.blocks.body.FullyConnected.fuse_for_inference`; fusing first folds the batchnorms into
+        the linear weights prior to rounding them.
+
+        Arguments:
+            dtype: type to use, e.g. `torch.bfloat16` for CPUs with native support, or `torch.float16` for GPUs
+        '''
+
+        self.eval().to(dtype)
+        for m in self.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm): m.float()
+        self.inference_dtype = dtype
+
+    def script(self, freeze:bool=False) -> torch.jit.ScriptModule:
+        r'''
+        Compile block via TorchScript, allowing the elementwise tails of the dense->activation->BN->DO chains to be fused into single kernels
+
+        Arguments:
+            freeze: if true, will set the block to evaluation mode and freeze it via `torch.jit.freeze`, inlining parameters and folding BN statistics where
+                possible. Frozen blocks can only be used for inference.
+
+        Returns:
+            Scripted block
+        '''
+
+        block = torch.jit.script(self)  # Scripted blocks cannot remap pre-v0.8.1 residual state dicts, so these should be loaded prior to scripting
+        if freeze: block = torch.jit.freeze(block.eval())
+        return block
     
     def get_out_size(self) -> int:
         r'''
@@ -167,6 +348,11 @@ class MultiBlock(AbsBody):
         lookup_init: function taking choice of activation function, number of inputs, and number of outputs an returning a function to initialise layer weights.
         lookup_act: function taking choice of activation function and returning an activation function layer
         freeze: whether to start with module parameters set to untrainable
+        batch_blocks: if true, and all blocks are plain (neither res nor dense) :class:`~lumin.nn.models.blocks.body.FullyConnected` blocks of the same depth,
+            activation, and dropout, the linear layers of all blocks will be computed together, using block-diagonal weight matrices, i.e. one large matrix
+            multiplication per layer, rather than one small one per block, improving GPU utilisation. Otherwise blocks are run separately. Since the blocks'
+            modules are not called by the batched computation, the blocks are also run separately whilst any hooks are registered on them, e.g. by
+            :class:`~lumin.nn.callbacks.lsuv_init.LsuvInit`. Requires PyTorch >= 1.8.
 
     Examples::
         >>> body = MultiBlock(
@@ -193,13 +379,15 @@ class MultiBlock(AbsBody):
         ...     bottleneck=True, bottleneck_act='swish')
     '''
 
+    __constants__ = ['batch_blocks']  # Allows TorchScript to skip the batched forward, which cannot be compiled
+
     def __init__(self, n_in:int, feat_map:Dict[str,List[int]], blocks:List[partial], feats_per_block:List[List[str]],
                  bottleneck_sz:int=0, bottleneck_act:Optional[str]=None,
                  lookup_init:Callable[[str,Optional[int],Optional[int]],Callable[[Tensor],None]]=lookup_normal_init,
-                 lookup_act:Callable[[str],Any]=lookup_act, freeze:bool=False):
+                 lookup_act:Callable[[str],Any]=lookup_act, freeze:bool=False, batch_blocks:bool=False):
         super().__init__(n_in=n_in, feat_map=feat_map, lookup_init=lookup_init, lookup_act=lookup_act, freeze=freeze)
         self.feats_per_block,self.bottleneck_sz,self.bottleneck_act = feats_per_block,bottleneck_sz,bottleneck_act
-        self.blocks,self.n_out,self.masks,self.bottleneck_blocks = [],0,[],None
+        self.blocks,self.n_out,self.block_widths,self.masks,self.bottleneck_blocks = [],0,[],[],None
         
         if self.bottleneck_sz > 0:
             self.bottleneck_blocks,self.bottleneck_masks = [],[]
@@ -214,8 +402,47 @@ class MultiBlock(AbsBody):
             self.masks.append([i for f in tmp_map for i in tmp_map[f]])
             self.blocks.append(b(n_in=len(self.masks[-1])+self.bottleneck_sz, feat_map=tmp_map, lookup_init=self.lookup_init,
                                  lookup_act=self.lookup_act, freeze=self.freeze))
-            self.n_out += self.blocks[-1].get_out_size()
+            self.block_widths.append(self.blocks[-1].get_out_size())
+            self.n_out += self.block_widths[-1]
         self.blocks = nn.ModuleList(self.blocks)
+        self._build_perm()
+        if batch_blocks and LooseVersion(torch.__version__) < LooseVersion("1.8"): raise ValueError("batch_blocks requires PyTorch version >= 1.8")
+        self.batch_blocks = batch_blocks and self._can_batch_blocks()
+        if self.freeze: self.freeze_layers()
+
+    def _can_batch_blocks(self) -> bool:
+        r'''
+        Check whether all blocks share the same structure, such that they can be run as a single block with block-diagonal weights
+        '''
+
+        if not all(isinstance(b, FullyConnected) and not b.res and not b.dense for b in self.blocks): return False
+        if len(set(len(b.layers) for b in self.blocks)) > 1: return False
+        for layers in zip(*[b.layers for b in self.blocks]):
+            if len(set(len(l) for l in layers)) > 1: return False
+            for ms in zip(*layers):
+                if len(set(type(m) for m in ms)) > 1: return False
+                if not _has_state(ms[0]) and len(set(repr(m) for m in ms)) > 1: return False  # Stateless modules are applied once to all blocks
+        return True
+
+    def _has_block_hooks(self) -> bool:
+        r'''
+        Check whether any forward hooks are registered on the modules of the blocks, which the batched forward would not call
+        '''
+
+        return any(len(m._forward_hooks) > 0 or len(m._forward_pre_hooks) > 0 for b in self.blocks for m in b.modules())
+
+    def _build_perm(self) -> None:
+        r'''
+        Concatenate the feature indices of all blocks (followed by those of all bottlenecks) into a single permutation, stored as a buffer, so that the inputs
+        of every block can be gathered at once. Each block's inputs are then a contiguous range of the permuted features, starting at the recorded offset.
+        '''
+
+        masks = self.masks if self.bottleneck_sz <= 0 else self.masks+self.bottleneck_masks
+        self.perm_offsets = [0]
+        for m in masks: self.perm_offsets.append(self.perm_offsets[-1]+len(m))
+        perm = torch.tensor([i for m in masks for i in m], dtype=torch.long)
+        if LooseVersion(torch.__version__) >= LooseVersion("1.6"): self.register_buffer('perm', perm, persistent=False)  # Keep state_dict same as older saves
+        else:                                                      self.register_buffer('perm', perm)
 
     def _get_bottleneck(self, mask:List[int]) -> nn.Module:
         layers = [nn.Linear(len(mask), self.bottleneck_sz)]
@@ -238,15 +465,47 @@ class MultiBlock(AbsBody):
         
         return self.n_out
     
+    def _batched_forward(self, x:Tensor) -> Tensor:
+        r'''
+        Pass concatenated inputs of all blocks through all blocks at once: linear layers use block-diagonal weights, layers with parameters or buffers (e.g.
+        batchnorm) are applied per block, and stateless layers (activations and dropout) are applied once
+        '''
+
+        widths = [len(m)+self.bottleneck_sz for m in self.masks]
+        for layers in zip(*[b.layers for b in self.blocks]):
+            for ms in zip(*layers):
+                if isinstance(ms[0], nn.Linear):
+                    x = F.linear(x, torch.block_diag(*[m.weight for m in ms]), torch.cat([m.bias for m in ms]))
+                    widths = [m.out_features for m in ms]
+                elif _has_state(ms[0]):
+                    x = torch.cat([m(y) for m, y in zip(ms, x.split(widths, 1))], -1)
+                else:
+                    x = ms[0](x)
+        return x
+
+    def _get_block_inputs(self, xp:Tensor) -> List[Tensor]:
+        r'''
+        Split the permuted inputs into the inputs of each block, appending the outputs of the bottlenecks, if used
+        '''
+
+        xs = [xp.narrow(1, self.perm_offsets[i], len(self.masks[i])) for i in range(len(self.masks))]
+        if self.bottleneck_blocks is not None:  # TorchScript only allows ModuleLists to be iterated, not indexed by variables
+            for i, bb in enumerate(self.bottleneck_blocks):
+                j = len(self.masks)+i
+                xs[i] = torch.cat((xs[i], bb(xp.narrow(1, self.perm_offsets[j], len(self.bottleneck_masks[i])))), -1)
+        return xs
+
     def forward(self, x:Tensor) -> Tensor:
-        y = None
+        xp = x.index_select(1, self.perm)
+        if self.batch_blocks:
+            if not self._has_block_hooks():
+                if self.bottleneck_blocks is None: xp = xp.narrow(1, 0, self.perm_offsets[len(self.blocks)])  # Block inputs are already contiguous
+                else:                              xp = torch.cat(self._get_block_inputs(xp), -1)
+                return self._batched_forward(xp)
+
+        xs = self._get_block_inputs(xp)
+        y, off = x.new_empty(x.shape[0], self.n_out), 0  # Output written in place to avoid repeated concatenation
         for i, b in enumerate(self.blocks):
-            if self.bottleneck_sz:
-                a = self.bottleneck_blocks[i](x[:,self.bottleneck_masks[i]])
-                tmp_x = torch.cat((x[:,self.masks[i]], a), -1)
-            else:
-                tmp_x = x[:,self.masks[i]]
-            out = b(tmp_x)
-            if y is None: y = out
-            else:         y = torch.cat((y, out), -1)
+            y[:,off:off+self.block_widths[i]] = b(xs[i])
+            off += self.block_widths[i]
         return y
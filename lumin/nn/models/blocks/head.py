@@ -1103,6 +1103,7 @@ class AutoExtractLorentzBoostNet(LorentzBoostNet):
         if n_pairs   > 0: self.pair_nn   = self._get_nn(n_in=8, depth=depth, width=width, n_out=n_pairs, act=act, do=do, bn=bn,
                                                         lookup_act=lookup_act, lookup_init=lookup_init)
         self.pre_bn = self.bn_class(4*self.n_particles)
+        if self.freeze: self.freeze_layers()  # Freeze new layers
     
     def _get_nn(self, n_in:int, depth:int, width:int, n_out:int, act:str, do:bool, bn:bool,
                 lookup_init:Callable[[str,Optional[int],Optional[int]],Callable[[Tensor],None]],
@@ -4,6 +4,7 @@ import pickle
 import math
 import numpy as np
 import warnings
+from functools import partial
 from distutils.version import LooseVersion
 
 import torch.nn as nn
@@ -14,7 +15,7 @@ import torch
 from .layers.activations import lookup_act
 from .initialisations import lookup_normal_init
 from .helpers import CatEmbedder
-from .blocks.body import FullyConnected, AbsBody
+from .blocks.body import FullyConnected, AbsBody, _remap_res_state_dict
 from .blocks.head import CatEmbHead, AbsHead
 from .blocks.tail import ClassRegMulti, AbsTail
 from ..losses.basic_weighted import WeightedCCE, WeightedMSE
@@ -28,6 +29,23 @@ Todo
 '''
 
 
+def _drop_state(module:nn.Module, state_dict:Dict[str,Tensor], prefix:str, local_metadata:Dict[str,Any], keys:List[str]) -> None:
+    r'''
+    State-dict hook removing the given keys, e.g. non-persistent buffers, which TorchScript saves regardless
+    '''
+
+    for k in keys: state_dict.pop(prefix+k, None)
+
+
+def _fill_state(state_dict:Dict[str,Tensor], prefix:str, *args, values:Dict[str,Tensor]) -> None:
+    r'''
+    Load-state-dict pre-hook adding the given values where missing, e.g. non-persistent buffers, which TorchScript expects regardless
+    '''
+
+    for k, v in values.items():
+        if prefix+k not in state_dict: state_dict[prefix+k] = v
+
+
 class ModelBuilder(object):
     r'''
     Class to build models to specified architecture on demand along with an optimiser.
@@ -51,6 +69,10 @@ class ModelBuilder(object):
         pretrain_file: if set, will load saved parameters for entire network from saved model
         freeze_head: whether to start with the head parameters set to untrainable
         freeze_body: whether to start with the body parameters set to untrainable
+        script_body: whether to compile the body via TorchScript when building the model, allowing elementwise operations to be fused.
+            Supported for :class:`~lumin.nn.models.blocks.body.FullyConnected`, :class:`~lumin.nn.models.blocks.body.IdentBody`, and
+            :class:`~lumin.nn.models.blocks.body.MultiBlock` bodies, except when `MultiBlock` uses `batch_blocks`; other bodies must be TorchScript-compatible.
+            Note that scripted modules do not support forward hooks, and so are incompatible with callbacks such as :class:`~lumin.nn.callbacks.lsuv_init.LsuvInit`
 
 
     Examples::
@@ -105,12 +127,13 @@ class ModelBuilder(object):
                  head:Callable[[Any],AbsHead]=CatEmbHead, body:Callable[[Any],AbsBody]=FullyConnected, tail:Callable[[Any],AbsTail]=ClassRegMulti,
                  lookup_init:Callable[[str,Optional[int],Optional[int]],Callable[[Tensor],None]]=lookup_normal_init,
                  lookup_act:Callable[[str],nn.Module]=lookup_act, pretrain_file:Optional[str]=None,
-                 freeze_head:bool=False, freeze_body:bool=False, freeze_tail:bool=False):
+                 freeze_head:bool=False, freeze_body:bool=False, freeze_tail:bool=False, script_body:bool=False):
         self.objective,self.cont_feats,self.n_out,self.cat_embedder = objective.lower(),cont_feats,n_out,cat_embedder
         self.cont_subsample_rate,self.guaranteed_feats = cont_subsample_rate,guaranteed_feats
         self.head,self.body,self.tail = head,body,tail
         self.lookup_init,self.lookup_act,self.pretrain_file, = lookup_init,lookup_act,pretrain_file
         self.freeze_head,self.freeze_body,self.freeze_tail = freeze_head,freeze_body,freeze_tail
+        self.script_body = script_body
         self._parse_loss(loss)
         self._parse_model_args(model_args)
         self._parse_opt_args(opt_args)
@@ -118,7 +141,7 @@ class ModelBuilder(object):
 
     @classmethod
     def from_model_builder(cls, model_builder, pretrain_file:Optional[str]=None, freeze_head:bool=False, freeze_body:bool=False, freeze_tail:bool=False,
-                           loss:Optional[Any]=None, opt_args:Optional[Dict[str,Any]]=None):
+                           loss:Optional[Any]=None, opt_args:Optional[Dict[str,Any]]=None, script_body:bool=False):
         r'''
         Instantiate a :class:`~lumin.nn.models.model_builder.ModelBuilder` from an exisitng :class:`~lumin.nn.models.model_builder.ModelBuilder`, but with options to adjust loss, optimiser, pretraining, and module freezing
 
@@ -133,6 +156,8 @@ class ModelBuilder(object):
                 either be set by passing the string name (e.g. `'adam'` ), but only ADAM and SGD are available this way, or by passing an uninstantiated
                 optimiser (e.g. torch.optim.Adam). If no optimser is set, then it defaults to ADAM. Additional keyword arguments can be set, and these will be
                 passed tot he optimiser during instantiation
+            script_body: whether to compile the body via TorchScript when building the model. See :class:`~lumin.nn.models.model_builder.ModelBuilder` for the
+                supported bodies
 
         Returns:
             Instantiated :class:`~lumin.nn.models.model_builder.ModelBuilder`
@@ -165,7 +190,8 @@ class ModelBuilder(object):
                    cat_embedder=model_builder.cat_embedder, model_args=model_args, opt_args=opt_args if opt_args is not None else {},
                    cont_subsample_rate=model_builder.cont_subsample_rate, guaranteed_feats=model_builder.guaranteed_feats,
                    loss=model_builder.loss if loss is None else loss, head=model_builder.head, body=model_builder.body, tail=model_builder.tail,
-                   pretrain_file=pretrain_file, freeze_head=freeze_head, freeze_body=freeze_body, freeze_tail=freeze_tail)
+                   pretrain_file=pretrain_file, freeze_head=freeze_head, freeze_body=freeze_body, freeze_tail=freeze_tail,
+                   script_body=script_body)
             
     def _parse_loss(self, loss:Union[Any,'auto']='auto') -> None:
         if loss == 'auto':
@@ -289,7 +315,26 @@ class ModelBuilder(object):
         head = self.get_head()
         body = self.get_body(head.get_out_size(), head.feat_map)
         tail = self.get_tail(body.get_out_size())
-        return nn.Sequential(head, body, tail)
+        if not hasattr(self, 'script_body'): self.script_body = False  # Backwards compatability with pre-v0.8.1 saves
+        res_prefixes = [f'1.{n}.' if n else '1.' for n, m in body.named_modules() if isinstance(m, FullyConnected) and m.res]
+        non_persistent = {f'1.{n}.{b}' if n else f'1.{b}': getattr(m, b).clone() for n, m in body.named_modules()
+                          for b in getattr(m, '_non_persistent_buffers_set', [])}
+        if self.script_body: body = self._script_body(body)
+        model = nn.Sequential(head, body, tail)
+        if self.script_body:  # Keep state dict the same as that of the unscripted body
+            for p in res_prefixes: model._register_load_state_dict_pre_hook(partial(_remap_res_state_dict, body_prefix=p))  # Pre-v0.8.1 residual saves
+            if len(non_persistent) > 0:  # E.g. MultiBlock.perm, which TorchScript would otherwise save and expect
+                model._register_state_dict_hook(partial(_drop_state, keys=list(non_persistent)))
+                model._register_load_state_dict_pre_hook(partial(_fill_state, values=non_persistent))
+        return model
+
+    @staticmethod
+    def _script_body(body:AbsBody) -> torch.jit.ScriptModule:
+        if getattr(body, 'batch_blocks', False): raise ValueError("script_body cannot be used with a MultiBlock using batch_blocks, please set one to False")
+        try:
+            return torch.jit.script(body)
+        except Exception as e:
+            raise ValueError(f"script_body is set, but the body {type(body).__name__} could not be compiled via TorchScript") from e
 
     def load_pretrained(self, model:nn.Module):
         r'''
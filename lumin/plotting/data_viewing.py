@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 from typing import List, Optional, Dict, Any, Union, Tuple
+from collections import OrderedDict
+import hashlib
 
 import scipy
 from scipy.cluster import hierarchy as hc
@@ -10,9 +12,33 @@ from ..utils.statistics import uncert_round, get_moments
 
 import seaborn as sns
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 
 __all__ = ['plot_feat', 'compare_events', 'plot_rank_order_dendrogram', 'plot_kdes_from_bs', 'plot_binary_sample_feat']
 
+_moments_cache = OrderedDict()
+
+
+def _get_cached_moments(arr:Union[np.ndarray,pd.Series], weights:Optional[np.ndarray]=None, maxsize:int=128) -> Tuple[float,float,float,float]:
+    r'''
+    Memoised version of :meth:`~lumin.utils.statistics.get_moments`, keyed by a digest of the data, so that repeated plots of the same data only require a
+    single pass to fingerprint it. The `maxsize` most recently used results are kept.
+    '''
+
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.blake2b(arr, digest_size=16)
+    if weights is not None:
+        weights = np.ascontiguousarray(weights)
+        digest.update(weights)
+    key = (arr.dtype.str, arr.shape, weights is not None, digest.digest())
+    if key in _moments_cache:
+        _moments_cache.move_to_end(key)
+    else:
+        _moments_cache[key] = get_moments(arr, weights)
+        if len(_moments_cache) > maxsize: _moments_cache.popitem(last=False)
+    return _moments_cache[key]
+
 
 def plot_feat(df:pd.DataFrame, feat:str, wgt_name:Optional[str]=None, cuts:Optional[List[pd.Series]]=None,
               labels:Optional[List[str]]='', plot_bulk:bool=True, n_samples:int=100000,
@@ -23,7 +49,8 @@ def plot_feat(df:pd.DataFrame, feat:str, wgt_name:Optional[str]=None, cuts:Optio
     A flexible function to provide indicative information about the 1D distribution of a feature.
     By default it will produce a weighted KDE+histogram for the [1,99] percentile of the data,
     as well as compute the mean and standard deviation of the data in this region.
-    Distributions are weighted by sampling with replacement the data with probabilities propotional to the sample weights.
+    If Seaborn's `histplot` is available (Seaborn >= 0.11) and used, distributions are weighted directly by the sample weights, otherwise they are weighted by
+    sampling with replacement the data with probabilities propotional to the sample weights. Categorical data are always weighted by sampling.
     By passing a list of cuts and labels, it will plot multiple distributions of the same feature for different cuts.
     Since it is designed to provide quick, indicative information, more specific functions (such as `plot_kdes_from_bs`)
     should be used to provide final results.
@@ -38,8 +65,9 @@ def plot_feat(df:pd.DataFrame, feat:str, wgt_name:Optional[str]=None, cuts:Optio
         cuts: optional list of cuts to apply to feature. Will add one KDE+hist for each cut listed on the same plot
         labels: optional list of labels for each KDE+hist
         plot_bulk: whether to plot the [1,99] percentile of the data, or all of it
-        n_samples: if plotting weighted distributions, how many samples to use
-        plot_params: optional list of of arguments to pass to Seaborn Distplot for each KDE+hist
+        n_samples: if plotting weighted distributions by sampling, how many samples to use
+        plot_params: optional list of of arguments to pass to Seaborn Histplot (or Distplot, if Histplot is unavailable) for each KDE+hist.
+            If arguments specific to Distplot are passed (e.g. `hist`, `hist_kws`, or `kde_kws`), Distplot will be used for that KDE+hist.
         size: string to pass to :meth:`~lumin.plotting.plot_settings.PlotSettings.str2sz` to determin size of plot
         show_moments: whether to compute and display the mean and standard deviation
         ax_labels: dictionary of x and y axes labels
@@ -50,6 +78,20 @@ def plot_feat(df:pd.DataFrame, feat:str, wgt_name:Optional[str]=None, cuts:Optio
     '''
 
     def _filter_data(x:Union[pd.DataFrame,pd.Series]) -> Union[pd.DataFrame,pd.Series]: return x.replace([np.inf,-np.inf],np.nan).dropna()
+    def _align_cut(cut:pd.Series) -> np.ndarray:  # Cuts, and combinations of cuts, may be ordered differently to df, so align prior to indexing by position
+        if not cut.index.equals(df.index): cut = cut.reindex(df.index, fill_value=False)
+        return cut.values
+    def _weight_data(x:np.ndarray, w:np.ndarray, hist:bool) -> Tuple[np.ndarray,Optional[np.ndarray]]:
+        w = w.astype('float64')
+        m = np.isfinite(x) & np.isfinite(w)
+        if not m.all(): x, w = x[m], w[m]
+        w /= w.sum()
+        if hist: return x, w
+        return x[rng.choice(len(x), n_samples, p=w)], None
+
+    rng = np.random.default_rng()
+    use_hist = hasattr(sns, 'histplot')  # Histplot computes weighted histograms and KDEs directly, and faster
+    distplot_kargs = {'hist', 'hist_kws', 'kde_kws', 'rug', 'rug_kws', 'fit', 'fit_kws', 'norm_hist', 'axlabel', 'vertical'}
 
     if not isinstance(labels, list): labels = [labels]
     if not isinstance(cuts,   list): cuts   = [cuts]
@@ -58,14 +100,20 @@ def plot_feat(df:pd.DataFrame, feat:str, wgt_name:Optional[str]=None, cuts:Optio
     cat = df[feat].nunique() < 50
     if ax_labels['y'] is None:
         ax_labels['y'] = 'Count' if cat else 'Density'
+    if plot_bulk and not cat:  # Selection of [1,99] percentile, rather than full sort
+        arr = _filter_data(df[feat]).values
+        k = [len(arr)//100, (99*len(arr))//100]
+        feat_range = np.partition(arr, k)[k]
         
     with sns.axes_style(**settings.style), sns.color_palette(settings.cat_palette) as palette:
         plt.figure(figsize=(settings.str2sz(size, 'x'), settings.str2sz(size, 'y')))
         for i in range(len(cuts)):
             tmp_plot_params = plot_params[i] if isinstance(plot_params, list) else plot_params
+            plot_wgts = None
+            hist = use_hist and len(distplot_kargs.intersection(tmp_plot_params)) == 0  # Distplot arguments are still passed to distplot
             
             if cat:
-                tmp_data = df if cuts[i] is None else df.loc[cuts[i]]
+                tmp_data = df if cuts[i] is None else df.loc[_align_cut(cuts[i])]
                 if wgt_name is None:
                     plot_data = _filter_data(tmp_data[feat])
                 else:
@@ -75,37 +123,34 @@ def plot_feat(df:pd.DataFrame, feat:str, wgt_name:Optional[str]=None, cuts:Optio
                     plot_data = tmp_data.sample(n=n_samples, replace=True, weights=weights)[feat]
                     
             elif plot_bulk:  # Ignore tails for indicative plotting
-                feat_range = np.percentile(_filter_data(df[feat]), [1, 99])
                 if feat_range[0] == feat_range[1]: break
                 cut = (df[feat] > feat_range[0]) & (df[feat] < feat_range[1])
                 if cuts[i] is not None: cut = cut & (cuts[i])
-                if wgt_name is None:
-                    plot_data = _filter_data(df.loc[cut, feat])
-                else:
-                    tmp = _filter_data(df.loc[cut, [wgt_name, feat]])
-                    weights = tmp[wgt_name].values.astype('float64')
-                    weights /= weights.sum()
-                    plot_data = np.random.choice(tmp[feat], n_samples, p=weights)
+                cut = _align_cut(cut)
+                if wgt_name is None: plot_data = df[feat].values[cut]  # Range cut already excludes NaNs and infs
+                else:                plot_data, plot_wgts = _weight_data(df[feat].values[cut], df[wgt_name].values[cut], hist)
                     
             else:
-                tmp_data = df if cuts[i] is None else df.loc[cuts[i]]
-                if wgt_name is None:
-                    plot_data = _filter_data(tmp_data[feat])
-                else:
-                    tmp_data = _filter_data(tmp_data[[wgt_name, feat]])
-                    weights = tmp_data[wgt_name].values.astype('float64')
-                    weights /= weights.sum()
-                    plot_data = np.random.choice(tmp_data[feat], n_samples, p=weights)
+                tmp_data = df if cuts[i] is None else df.loc[_align_cut(cuts[i])]
+                if wgt_name is None: plot_data = _filter_data(tmp_data[feat])
+                else:                plot_data, plot_wgts = _weight_data(tmp_data[feat].values, tmp_data[wgt_name].values, hist)
             label = labels[i]
+            if not cat:
+                n = len(plot_data)
+                if plot_wgts is not None and n > 0: n = (plot_wgts.sum()**2)/(plot_wgts**2).sum()  # Effective sample size, as used by get_moments
             if show_moments and not cat:
-                moms = get_moments(plot_data)
-                mean = uncert_round(moms[0], moms[1])
-                std  = uncert_round(moms[2], moms[3])
-                if wgt_name is None: label += r' $\bar{x}=$' + f'{mean[0]}±{mean[1]}' + r', $\sigma_x=$' + f'{std[0]}±{std[1]}'
-                else:                label += r' $\bar{x}=$' + f'{mean[0]}' + r', $\sigma_x=$' + f'{std[0]}'
+                if not n >= 2:  # Moments undefined
+                    label += f' (no moments, n={n:.3g})'
+                else:
+                    moms = _get_cached_moments(plot_data, plot_wgts)
+                    mean = uncert_round(moms[0], moms[1])
+                    std  = uncert_round(moms[2], moms[3])
+                    if wgt_name is None: label += r' $\bar{x}=$' + f'{mean[0]}±{mean[1]}' + r', $\sigma_x=$' + f'{std[0]}±{std[1]}'
+                    else:                label += r' $\bar{x}=$' + f'{mean[0]}' + r', $\sigma_x=$' + f'{std[0]}'
 
-            if cat: sns.countplot(plot_data, label=label, color=palette[0], **tmp_plot_params)
-            else:   sns.distplot(plot_data, label=label, **tmp_plot_params)
+            if cat:     sns.countplot(plot_data, label=label, color=palette[0], **tmp_plot_params)
+            elif hist: sns.histplot(x=plot_data, weights=plot_wgts, label=label, **{'stat': 'density', 'kde': bool(n >= 2), **tmp_plot_params})
+            else:      sns.distplot(plot_data, label=label, **tmp_plot_params)
 
         if len(cuts) > 1 or show_moments: plt.legend(loc=settings.leg_loc, fontsize=settings.leg_sz)
         if log_y: plt.yscale('log')
@@ -132,39 +177,39 @@ def compare_events(events:list) -> None:
     # TODO: make this work with a single event
     # TODO: add plot settings & saving
 
-    with sns.axes_style('whitegrid'), sns.color_palette('tab10'):
+    with sns.axes_style('whitegrid'), sns.color_palette('tab10') as palette:
         fig, axs = plt.subplots(3, len(events), figsize=(9*len(events), 18), gridspec_kw={'height_ratios': [1, 0.5, 0.5]})
-        for vector in [x[:-3] for x in events[0].columns if '_px' in x.lower()]:
-            for i, in_data in enumerate(events):
-                x = in_data[vector + '_px'].values[0]
-                try: y = in_data[vector + '_py'].values[0]
-                except KeyError: y = 0
-                try: z = in_data[vector + '_pz'].values[0]
-                except KeyError: z = 0
-                axs[0, i].plot((0, x), (0, y), label=vector)
-                axs[1, i].plot((0, z), (0, x), label=vector)
-                axs[2, i].plot((0, z), (0, y), label=vector)
+        vectors = [x[:-3] for x in events[0].columns if '_px' in x.lower()]
+        colours = [palette[j % len(palette)] for j in range(len(vectors))]
+        handles = [Line2D([], [], color=c, label=v) for v, c in zip(vectors, colours)]
+        for i, in_data in enumerate(events):
+            # Missing py or pz components are taken to be zero
+            p = in_data.reindex(columns=[f'{v}_p{c}' for v in vectors for c in 'xyz'], fill_value=0).values[0].reshape(-1, 3)
+            for ax, (h, v) in zip(axs[:, i], [(0, 1), (2, 0), (2, 1)]):  # Draw all vectors in one collection per projection
+                segs = np.zeros((len(vectors), 2, 2))
+                segs[:, 1, 0], segs[:, 1, 1] = p[:, h], p[:, v]
+                ax.add_collection(LineCollection(segs, colors=colours))
         for ax in axs[0]:
             ax.add_artist(plt.Circle((0, 0), 1, color='grey', fill=False, linewidth=2))
             ax.set_xlim(-1.1, 1.1)
             ax.set_ylim(-1.1, 1.1)
             ax.set_xlabel(r"$p_x$", fontsize=16, color='black')
             ax.set_ylabel(r"$p_y$", fontsize=16, color='black')
-            ax.legend(loc='right', fontsize=12)  
+            ax.legend(handles=handles, loc='right', fontsize=12)  
         for ax in axs[1]:
             ax.add_artist(plt.Rectangle((-2, -1), 4, 2, color='grey', fill=False, linewidth=2))
             ax.set_xlim(-2.2, 2.2)
             ax.set_ylim(-1.1, 1.1)
             ax.set_xlabel(r"$p_z$", fontsize=16, color='black')
             ax.set_ylabel(r"$p_x$", fontsize=16, color='black')
-            ax.legend(loc='right', fontsize=12)
+            ax.legend(handles=handles, loc='right', fontsize=12)
         for ax in axs[2]: 
             ax.add_artist(plt.Rectangle((-2, -1), 4, 2, color='grey', fill=False, linewidth=2))
             ax.set_xlim(-2.2, 2.2)
             ax.set_ylim(-1.1, 1.1)
             ax.set_xlabel(r"$p_z$", fontsize=16, color='black')
             ax.set_ylabel(r"$p_y$", fontsize=16, color='black')
-            ax.legend(loc='right', fontsize=12)
+            ax.legend(handles=handles, loc='right', fontsize=12)
         fig.show()
 
 
@@ -64,12 +64,13 @@ def bootstrap_stats(args:Dict[str,Any], out_q:Optional[mp.Queue]=None) -> Union[
     else: return out_dict
 
 
-def get_moments(arr:np.ndarray) -> Tuple[float,float,float,float]:
+def get_moments(arr:np.ndarray, weights:Optional[np.ndarray]=None) -> Tuple[float,float,float,float]:
     r'''
     Computes mean and std of data, and their associated uncertainties
 
     Arguments:
         arr: univariate data
+        weights: optional weights for the data, in which case the effective sample size, (sum w)^2/sum(w^2), is used to compute the uncertainties
 
     Returns:
         - mean
@@ -78,10 +79,16 @@ def get_moments(arr:np.ndarray) -> Tuple[float,float,float,float]:
         - statistical uncertainty of standard deviation
     '''
 
-    n = len(arr)
-    m = np.mean(arr)
-    m_4 = np.mean((arr-m)**4)
-    s = np.std(arr, ddof=1)
+    if weights is None:
+        n = len(arr)
+        m = np.mean(arr)
+        m_4 = np.mean((arr-m)**4)
+        s = np.std(arr, ddof=1)
+    else:
+        n = (weights.sum()**2)/(weights**2).sum()
+        m = np.average(arr, weights=weights)
+        m_4 = np.average((arr-m)**4, weights=weights)
+        s = np.sqrt(np.average((arr-m)**2, weights=weights)*n/(n-1))
     s4 = s**4
     se_s2 = ((m_4-(s4*(n-3)/(n-1)))/n)**0.25
     se_s = se_s2/(2*s)